@@ -1,6 +1,7 @@
 import os
 import base64
-import json
+
+import orjson
 
 import firebase_admin
 from firebase_admin import credentials, firestore
@@ -12,21 +13,21 @@ def get_firestore_client():
     Initialize or retrieve a Firebase app using Base64-encoded credentials
     from the FIREBASE_CREDENTIALS environment variable, and return a Firestore client.
     """
-    # 1. Load the base64-encoded JSON from environment variable
-    firebase_credentials_base64 = os.getenv("FIREBASE_CREDENTIALS")
-    if not firebase_credentials_base64:
-        raise ValueError("FIREBASE_CREDENTIALS environment variable is missing or empty!")
-
-    # 2. Decode Base64 → JSON
-    try:
-        firebase_credentials_json = base64.b64decode(firebase_credentials_base64).decode("utf-8")
-        firebase_credentials = json.loads(firebase_credentials_json)
-    except Exception as e:
-        raise ValueError(f"Failed to decode FIREBASE_CREDENTIALS Base64 data: {e}")
-
-    # 3. Initialize the named Firebase app if it's not already initialized
+    # 1. Initialize the named Firebase app if it's not already initialized
     if APP_NAME not in firebase_admin._apps:
         print(f"\n[Firebase Setup] No existing app named '{APP_NAME}' found. Initializing...")
+
+        # 2. Load the base64-encoded JSON from environment variable
+        firebase_credentials_base64 = os.getenv("FIREBASE_CREDENTIALS")
+        if not firebase_credentials_base64:
+            raise ValueError("FIREBASE_CREDENTIALS environment variable is missing or empty!")
+
+        # 3. Decode Base64 → JSON
+        try:
+            firebase_credentials = orjson.loads(base64.b64decode(firebase_credentials_base64))
+        except Exception as e:
+            raise ValueError(f"Failed to decode FIREBASE_CREDENTIALS Base64 data: {e}")
+
         try:
             cred = credentials.Certificate(firebase_credentials)
             firebase_admin.initialize_app(cred, name=APP_NAME)
@@ -1,19 +1,81 @@
+import os
+
+# Opt-in cooperative workers (gunicorn -k gevent). Patching has to happen
+# before anything else imports socket/threading, and Firestore and Gemini
+# both talk gRPC, which needs its own gevent hook on top of patch_all().
+# gevent itself is optional: pip install -r requirements-gevent.txt
+if os.getenv("USE_GEVENT") == "1":
+    from gevent import monkey
+    monkey.patch_all()
+    import grpc.experimental.gevent as grpc_gevent
+    grpc_gevent.init_gevent()
+
 import sys
 import re
-import os
-import json
 import random
+import atexit
+import hashlib
+import itertools
+import threading
+import time
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 import base64
-from flask import Flask, request, jsonify, render_template
+from html import escape
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from dataclasses import dataclass, field, asdict
+from typing import Optional
+import orjson
+from flask import Flask, Response, request, jsonify, make_response, render_template, stream_with_context
+from flask.json.provider import JSONProvider
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from werkzeug.middleware.proxy_fix import ProxyFix
 import google.generativeai as genai
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core.exceptions import Aborted, Conflict, NotFound
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.rpc import code_pb2
 
 ###############################################################################
 # 1. Flask Setup
 ###############################################################################
+class OrjsonProvider(JSONProvider):
+    """Routes jsonify() and request.json through orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=str).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+# Behind the platform's router, set TRUSTED_PROXY_HOPS to the number of
+# proxies in front of us so per-client limits see the real client address.
+# Left at 0, X-Forwarded-For is ignored: without a proxy stripping it, any
+# client could spoof a fresh address per request and dodge the limits.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+if TRUSTED_PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
+# Per-client caps, so one chatty client can't burn the Gemini quota or flood
+# Firestore for everyone else. Counters are per process.
+PROMPT_RATE_LIMIT = "5/second;120/minute"
+WRITE_RATE_LIMIT = "10/second"
+limiter = Limiter(get_remote_address, app=app, storage_uri="memory://")
+
+@app.errorhandler(429)
+def rate_limited(e):
+    # The chat page reads every reply as JSON, so don't send the HTML page
+    return jsonify({"error": f"Too many requests ({e.description}). Please slow down."}), 429
+
+# Reloader + interactive debugger only when explicitly asked for
+DEBUG = os.getenv("FLASK_DEBUG") == "1"
 
 ###############################################################################
 # 2. Configure Logging
@@ -26,6 +88,7 @@ logger = logging.getLogger()
 logger.setLevel(logging.DEBUG)
 
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
+output_handlers = []
 
 if ENV == "development":
     # File Handler for Development
@@ -34,49 +97,157 @@ if ENV == "development":
         os.makedirs("logs")
     file_handler = logging.FileHandler("logs/app.log")
     file_handler.setLevel(logging.DEBUG)
-    file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    output_handlers.append(file_handler)
 
 # Console Handler for All Environments
 console_handler = logging.StreamHandler(sys.stdout)
 console_handler.setLevel(logging.DEBUG)
-console_handler.setFormatter(formatter)
-logger.addHandler(console_handler)
+output_handlers.append(console_handler)
+
+# Request threads only format and enqueue records; the listener thread does
+# the file and console writes
+_log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(_log_queue)
+queue_handler.setFormatter(formatter)
+logger.addHandler(queue_handler)
+_log_listener = QueueListener(_log_queue, *output_handlers, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+# A worker forked from a preloaded master inherits the queue but not the
+# listener thread, so it starts its own
+os.register_at_fork(after_in_child=_log_listener.start)
 
 ###############################################################################
 # 3. Configure Gemini (Google Generative AI)
 ###############################################################################
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-if not GEMINI_API_KEY:
-    raise ValueError("GEMINI_API_KEY environment variable not set.")
-
-genai.configure(api_key=GEMINI_API_KEY)
 # If you do NOT have access to gemini-1.5-flash, switch to "models/chat-bison-001"
-model = genai.GenerativeModel("models/gemini-1.5-flash")
+GEMINI_MODEL = "models/gemini-1.5-flash"
+
+# Gemini and Firebase are set up on first use rather than at import, so a
+# cold start (or a plain import) doesn't pay for them up front
+@lru_cache(maxsize=1)
+def configure_genai():
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        raise ValueError("GEMINI_API_KEY environment variable not set.")
+    genai.configure(api_key=api_key)
+
+@lru_cache(maxsize=1)
+def get_model():
+    configure_genai()
+    return genai.GenerativeModel(GEMINI_MODEL)
+
+# Caps in-flight Gemini calls per process, so a burst of prompts queues here
+# rather than fanning out into the API's rate limits
+GEMINI_MAX_CONCURRENCY = 8
+_gemini_slots = threading.BoundedSemaphore(GEMINI_MAX_CONCURRENCY)
+
+def generate_content(prompt):
+    with _gemini_slots:
+        return get_model().generate_content(prompt)
+
+class LLMCache:
+    """
+    Thread-safe LRU of Gemini reply texts keyed by prompt, with a TTL.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(prompt):
+        raw = orjson.dumps({"model": GEMINI_MODEL, "prompt": prompt}, option=orjson.OPT_SORT_KEYS)
+        return hashlib.sha256(raw).hexdigest()
+
+    def get(self, key, ttl):
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None:
+                return None
+            text, ts = hit
+            if time.time() - ts > ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return text
+
+    def set(self, key, text):
+        with self._lock:
+            self._data[key] = (text, time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+llm_cache = LLMCache()
+
+def normalize_prompt(prompt):
+    """
+    Collapses whitespace so trivially different spellings of a prompt share
+    a cache key. Case is kept: it carries names and IDs.
+    """
+    return " ".join(prompt.split())
+
+def cached_generate(prompt, ttl=1800):
+    """
+    generate_content() behind llm_cache. Returns the stripped reply
+    text, or None (not cached) when Gemini returns no candidates.
+    """
+    key = LLMCache.key(prompt)
+    text = llm_cache.get(key, ttl)
+    if text is not None:
+        return text
+    resp = generate_content(prompt)
+    if not resp.candidates:
+        return None
+    text = resp.candidates[0].content.parts[0].text.strip()
+    llm_cache.set(key, text)
+    return text
 
 ###############################################################################
 # 4. Firebase Initialization (Base64 credentials)
 ###############################################################################
-if 'student_management_app' not in firebase_admin._apps:
-    encoded_json = os.getenv("FIREBASE_CREDENTIALS")
-    if not encoded_json:
-        raise EnvironmentError("FIREBASE_CREDENTIALS not set or empty.")
-    try:
-        decoded_json = base64.b64decode(encoded_json).decode('utf-8')
-        service_account_info = json.loads(decoded_json)
-        cred = credentials.Certificate(service_account_info)
-        firebase_admin.initialize_app(cred, name='student_management_app')
-    except Exception as e:
-        raise Exception(f"Error initializing Firebase: {e}")
-
-db = firestore.client(app=firebase_admin.get_app('student_management_app'))
-logging.info("✅ Firebase and Firestore initialized successfully.")
+_firebase_init_lock = threading.Lock()
+
+@lru_cache(maxsize=1)
+def get_db():
+    with _firebase_init_lock:
+        if 'student_management_app' not in firebase_admin._apps:
+            encoded_json = os.getenv("FIREBASE_CREDENTIALS")
+            if not encoded_json:
+                raise EnvironmentError("FIREBASE_CREDENTIALS not set or empty.")
+            try:
+                service_account_info = orjson.loads(base64.b64decode(encoded_json))
+                cred = credentials.Certificate(service_account_info)
+                firebase_admin.initialize_app(cred, name='student_management_app')
+            except Exception as e:
+                raise Exception(f"Error initializing Firebase: {e}")
+            # The app holds its own credential now; don't keep the blob around
+            os.environ.pop("FIREBASE_CREDENTIALS", None)
+
+    client = firestore.client(app=firebase_admin.get_app('student_management_app'))
+    logging.info("✅ Firebase and Firestore initialized successfully.")
+    return client
+
+# Hot refs, resolved once per process instead of on every call
+@lru_cache(maxsize=1)
+def students_ref():
+    return get_db().collection("students")
+
+@lru_cache(maxsize=1)
+def activity_log_ref():
+    return get_db().collection("activity_log")
+
+@lru_cache(maxsize=1)
+def memory_doc_ref():
+    return get_db().collection("conversation_memory").document("session_1")
 
 ###############################################################################
 # 5. Conversation + States
 ###############################################################################
-conversation_memory = []
 MAX_MEMORY = 20
+# Bounded: appending past MAX_MEMORY drops the oldest entries
+conversation_memory = deque(maxlen=MAX_MEMORY)
 welcome_summary = ""
 
 # States
@@ -86,25 +257,140 @@ STATE_AWAITING_ANALYTICS_TARGET = "AWAITING_ANALYTICS_TARGET"
 STATE_AWAITING_DELETE_CHOICE = "STATE_AWAITING_DELETE_CHOICE"
 STATE_AWAITING_VIEW_FILTER = "AWAITING_VIEW_FILTER"  # New State for Filtering
 
-conversation_context = {
-    "state": STATE_IDLE,
-    "pending_params": {},
-    "last_intended_action": None,
-    "delete_candidates": []
-}
+# States whose next prompt is an answer for handle_state_machine
+FOLLOW_UP_STATES = (STATE_AWAITING_DELETE_CHOICE, STATE_AWAITING_VIEW_FILTER)
+
+@dataclass(slots=True)
+class ConvContext:
+    state: str = STATE_IDLE
+    pending_params: dict = field(default_factory=dict)
+    last_intended_action: Optional[str] = None
+    delete_candidates: list = field(default_factory=list)
+
+    def update(self, data):
+        """Apply a context dict loaded from Firestore; unknown keys are ignored."""
+        for k, v in data.items():
+            if k in self.__slots__:
+                setattr(self, k, v)
+
+conversation_context = ConvContext()
+
+# Digest of the last payload written, so unchanged memory skips the write
+_last_save_hash = None
+
+# Memory saves and activity-log entries share one background writer: callers
+# only mark memory dirty or buffer an entry, and the writer commits whatever
+# is pending as a single WriteBatch at most once per interval. Memory is
+# rewritten wholesale, so only its latest snapshot is ever sent.
+WRITE_INTERVAL_SECONDS = 0.5
+WRITE_RETRY_MAX_SECONDS = 30
+LOG_BATCH_SIZE = 450
+_log_pending = []
+_memory_dirty = False
+_pending_lock = threading.Lock()
+_writes_pending = threading.Event()
+_flush_lock = threading.Lock()
 
 def save_memory_to_firestore():
-    try:
-        db.collection('conversation_memory').document('session_1').set({
-            "memory": conversation_memory,
-            "context": conversation_context
+    global _memory_dirty
+    with _pending_lock:
+        _memory_dirty = True
+    _writes_pending.set()
+    _start_writer()
+
+def log_activity(action_type, details):
+    with _pending_lock:
+        _log_pending.append({
+            "action_type": action_type,
+            "details": details,
+            "timestamp": firestore.SERVER_TIMESTAMP
         })
-    except Exception as e:
-        logging.error(f"❌ Failed to save memory: {e}")
+    _writes_pending.set()
+    _start_writer()
+
+@lru_cache(maxsize=1)
+def _start_writer():
+    t = threading.Thread(target=_writer, name="firestore-writer", daemon=True)
+    t.start()
+    return t
+
+def _writer():
+    retry_delay = WRITE_INTERVAL_SECONDS
+    while True:
+        _writes_pending.wait()
+        time.sleep(WRITE_INTERVAL_SECONDS)  # let a burst of writes gather
+        _writes_pending.clear()
+        try:
+            ok = flush_pending_writes()
+        except Exception as e:
+            # Never let an error end the only writer thread
+            logging.error(f"❌ Writer error: {e}")
+            ok = False
+        if ok:
+            retry_delay = WRITE_INTERVAL_SECONDS
+        else:
+            # Failed writes were requeued; retry them with backoff rather
+            # than waiting for unrelated traffic to wake the writer
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, WRITE_RETRY_MAX_SECONDS)
+            _writes_pending.set()
+
+def flush_pending_writes():
+    """
+    Commits pending memory and log writes. Returns False if a commit
+    failed and its writes were requeued.
+    """
+    global _memory_dirty, _last_save_hash
+    with _flush_lock:
+        with _pending_lock:
+            entries = _log_pending[:]
+            _log_pending.clear()
+            memory_dirty, _memory_dirty = _memory_dirty, False
+        sent = 0  # log entries committed so far
+        try:
+            payload = None
+            if memory_dirty:
+                payload = {
+                    "memory": list(conversation_memory),
+                    "context": asdict(conversation_context)
+                }
+                h = hashlib.blake2b(
+                    orjson.dumps(payload, option=orjson.OPT_SORT_KEYS, default=str), digest_size=16
+                ).digest()
+                if h == _last_save_hash:
+                    payload = None
+                    memory_dirty = False
+            if payload is None and not entries:
+                return True
+            # The memory doc rides along with the first chunk of log entries
+            for i in range(0, max(len(entries), 1), LOG_BATCH_SIZE):
+                batch = get_db().batch()
+                if memory_dirty:
+                    batch.set(memory_doc_ref(), payload)
+                chunk = entries[i:i + LOG_BATCH_SIZE]
+                for entry in chunk:
+                    batch.set(activity_log_ref().document(), entry)
+                batch.commit()
+                sent += len(chunk)
+                if memory_dirty:
+                    _last_save_hash = h
+                    memory_dirty = False
+            return True
+        except Exception as e:
+            logging.error(f"❌ Failed to flush writes: {e}")
+            # Whatever didn't land goes back in front of newer writes and is
+            # retried by the next flush
+            with _pending_lock:
+                _log_pending[:0] = entries[sent:]
+                _memory_dirty = _memory_dirty or memory_dirty
+            return False
+
+# Don't lose pending writes when the process exits inside the window
+atexit.register(flush_pending_writes)
 
 def load_memory_from_firestore():
     try:
-        doc = db.collection('conversation_memory').document('session_1').get()
+        doc = memory_doc_ref().get()
         if doc.exists:
             data = doc.to_dict()
             return data.get("memory", []), data.get("context", {})
@@ -113,26 +399,20 @@ def load_memory_from_firestore():
         logging.error(f"❌ Failed to load memory: {e}")
         return [], {}
 
-def log_activity(action_type, details):
-    try:
-        db.collection('activity_log').add({
-            "action_type": action_type,
-            "details": details,
-            "timestamp": firestore.SERVER_TIMESTAMP
-        })
-    except Exception as e:
-        logging.error(f"❌ Failed to log activity: {e}")
-
 ###############################################################################
 # 6. Summaries
 ###############################################################################
 def generate_comedic_summary_of_past_activities():
     """
     Grabs last 100 logs from 'activity_log' and asks Gemini to produce
-    a short dark/funny summary.
+    a short dark/funny summary. The summary is stored in meta/welcome with
+    a hash of the logs it was made from, so a restart with no new activity
+    reuses it instead of calling Gemini again.
     """
     try:
-        logs = db.collection('activity_log').order_by('timestamp').limit(100).stream()
+        meta_ref = get_db().collection('meta').document('welcome')
+        cached = _EXECUTOR.submit(meta_ref.get)
+        logs = activity_log_ref().order_by('timestamp').limit(100).stream()
         lines = []
         for l in logs:
             d = l.to_dict()
@@ -140,13 +420,21 @@ def generate_comedic_summary_of_past_activities():
         if not lines:
             return "Strangely quiet. No records... yet."
 
+        log_text = "\n".join(lines)
+        version = hashlib.md5(log_text.encode()).hexdigest()
+        meta = cached.result().to_dict() or {}
+        if meta.get("version") == version and meta.get("summary"):
+            return meta["summary"]
+
         prompt = (
             "As a grimly funny AI, summarize these student management logs under 50 words:\n\n"
-            + "\n".join(lines)
+            + log_text
         )
-        resp = model.generate_content(prompt)
+        resp = generate_content(prompt)
         if resp.candidates:
-            return resp.candidates[0].content.parts[0].text.strip()
+            summary = resp.candidates[0].content.parts[0].text.strip()
+            meta_ref.set({"summary": summary, "version": version})
+            return summary
         else:
             return "No comedic summary. The silence is deafening."
     except Exception as e:
@@ -156,9 +444,10 @@ def generate_comedic_summary_of_past_activities():
 ###############################################################################
 # 7. Utils
 ###############################################################################
+_FENCE_RE = re.compile(r'^```(?:json)?\s*([\s\S]*?)\s*```$')
+
 def remove_code_fences(text: str) -> str:
-    fenced_pattern = r'^```(?:json)?\s*([\s\S]*?)\s*```$'
-    match = re.match(fenced_pattern, text.strip())
+    match = _FENCE_RE.match(text.strip())
     if match:
         return match.group(1).strip()
     return text
@@ -166,65 +455,201 @@ def remove_code_fences(text: str) -> str:
 def _safe_int(value):
     if value is None:
         return None
-    if isinstance(value, int):
-        return value
-    if isinstance(value, str) and value.isdigit():
+    try:
         return int(value)
-    return None
+    except (TypeError, ValueError):
+        return None
 
 ###############################################################################
 # 8. Firestore Logic
 ###############################################################################
+# Firestore rejects write batches with more than 500 operations
+FIRESTORE_BATCH_LIMIT = 500
+
+# Per-write retry budget for BulkWriter jobs
+BULK_WRITE_ATTEMPTS = 5
+
+# Shared pool for overlapping independent Firestore round-trips
+_EXECUTOR = ThreadPoolExecutor(max_workers=20)
+
+# Keep a margin under the hard batch limit; contended chunks get retried
+COMMIT_CHUNK_SIZE = FIRESTORE_BATCH_LIMIT - 50
+COMMIT_RETRIES = 3
+
+def _commit_chunks(updates, chunk_size=COMMIT_CHUNK_SIZE):
+    """
+    Commits (ref, fields) updates as WriteBatches of at most chunk_size ops,
+    with the chunks committed in parallel on _EXECUTOR. A chunk that loses a
+    contention race (Aborted/Conflict) is rebuilt and retried with backoff;
+    any other failure drops just that chunk. Returns the IDs of the docs in
+    chunks that committed.
+    """
+    def commit(chunk):
+        for attempt in range(COMMIT_RETRIES):
+            batch = get_db().batch()
+            for ref, fields in chunk:
+                batch.update(ref, fields)
+            try:
+                batch.commit()
+                return [ref.id for ref, _ in chunk]
+            except (Aborted, Conflict) as e:
+                if attempt == COMMIT_RETRIES - 1:
+                    logging.error(f"❌ Bulk update chunk failed: {e}")
+                    return []
+                time.sleep(0.1 * 2 ** attempt)
+            except Exception as e:
+                logging.error(f"❌ Bulk update chunk failed: {e}")
+                return []
+
+    chunks = [updates[i:i + chunk_size] for i in range(0, len(updates), chunk_size)]
+    return [sid for ids in _EXECUTOR.map(commit, chunks) for sid in ids]
+
+STUDENT_PAGE_SIZE = 100
+
+def stream_pages(query, page_size=STUDENT_PAGE_SIZE):
+    """
+    Yields every doc matched by query, fetched page_size docs at a time in
+    document-ID order, so no single stream has to stay open for the whole
+    collection.
+    """
+    query = query.order_by("__name__").limit(page_size)
+    last = None
+    while True:
+        page = query if last is None else query.start_after(last)
+        count = 0
+        for snap in page.stream():
+            count += 1
+            last = snap
+            yield snap
+        if count < page_size:
+            return
+
+# Repeat student-table reads ("view students" after every delete/save) are
+# served from memory for a few seconds. Every write path calls
+# invalidate_students_cache(); the generation counter keeps a read that
+# straddled a write from storing its stale result.
+STUDENTS_CACHE_TTL = 5
+_students_cache = {}  # query key -> (fetched_at, snapshots)
+_students_cache_gen = 0
+_students_cache_lock = threading.Lock()
+
+def invalidate_students_cache():
+    global _students_cache_gen
+    with _students_cache_lock:
+        _students_cache_gen += 1
+        _students_cache.clear()
+
+def cached_student_docs(key, query):
+    """
+    Iterator over the snapshots of query: from the cache while fresh,
+    otherwise paged from Firestore and cached once fully read.
+    """
+    with _students_cache_lock:
+        hit = _students_cache.get(key)
+    if hit and time.time() - hit[0] < STUDENTS_CACHE_TTL:
+        return iter(hit[1])
+    return _record_student_docs(key, query)
+
+def _record_student_docs(key, query):
+    with _students_cache_lock:
+        gen = _students_cache_gen
+    fetched_at = time.time()
+    docs = []
+    for snap in stream_pages(query):
+        docs.append(snap)
+        yield snap
+    with _students_cache_lock:
+        if gen == _students_cache_gen:
+            _students_cache[key] = (fetched_at, docs)
+
 def delete_student_doc(doc_id):
     """
     Directly delete doc from Firestore by ID.
     Returns (ok, message).
     """
-    ref = db.collection("students").document(doc_id)
-    snap = ref.get()
-    if not snap.exists():
+    ref = students_ref().document(doc_id)
+    # The precondition makes a missing doc fail the delete, saving the
+    # separate existence read
+    try:
+        ref.delete(option=get_db().write_option(exists=True))
+    except NotFound:
         return False, "No doc with that ID."
-    ref.delete()
+    invalidate_students_cache()
     return True, "deleted"
 
 ###############################################################################
 # 9. Student Functions
 ###############################################################################
+# Sequential suffixes can't repeat within a process the way random re-rolls
+# could; the random start keeps worker processes on different sequences
+_ID_COUNTER = itertools.count(random.randint(1000, 9999))
+
 def gen_student_id(name, age, division):
-    r = random.randint(1000, 9999)
+    r = next(_ID_COUNTER) % 10000
     part = (name[:4].upper() if len(name) >= 4 else name.upper())
     a = str(age) if age else "00"
     d = division.upper()
-    return f"{part}{a}{d}{r}"
+    return f"{part}{a}{d}{r:04d}"
+
+# Confirmations don't depend on which student was touched, so the prompts
+# leave names and IDs out and each action keeps a small pool of phrasings.
+# Requests only ever read the pool; while it's short, Gemini fills it in
+# the background, one phrasing at a time.
+CONFIRMATION_POOL_SIZE = 8
+CONFIRMATION_PROMPTS = {
+    "add_student": "Generate a short, darkly funny success message confirming a new student was added.",
+    "delete_student": "Create a short, darkly witty message confirming a student record was deleted.",
+    "add_grade": "Generate a humorous confirmation for adding a new grade record.",
+    "delete_grade": "Create a short, darkly witty message confirming a grade was deleted.",
+    "update_grade": "Generate a humorous confirmation for updating grades.",
+}
+_confirmation_pool = {}  # action -> phrasings
+_confirmation_filling = set()  # actions with a fill in flight
+_confirmation_lock = threading.Lock()
 
 def comedic_confirmation(action, name=None, doc_id=None):
-    if action == "add_student":
-        pr = f"Generate a short, darkly funny success confirming new student {name} ID {doc_id}."
-    elif action == "delete_student":
-        pr = f"Create a short, darkly witty message confirming the deletion of ID {doc_id}."
-    elif action == "add_grade":
-        pr = f"Generate a humorous confirmation for adding a new grade for subject {name} with ID {doc_id}."
-    elif action == "delete_grade":
-        pr = f"Create a short, darkly witty message confirming the deletion of grade for ID {doc_id}."
-    elif action == "update_grade":
-        pr = f"Generate a humorous confirmation for updating grades for subject ID {doc_id}."
-    else:
-        pr = "A cryptic success message."
-    resp = model.generate_content(pr)
-    if resp.candidates:
-        return resp.candidates[0].content.parts[0].text.strip()[:100]
-    else:
-        return "Action done."
+    with _confirmation_lock:
+        pool = list(_confirmation_pool.get(action, ()))
+        fill = len(pool) < CONFIRMATION_POOL_SIZE and action not in _confirmation_filling
+        if fill:
+            _confirmation_filling.add(action)
+    if fill:
+        _EXECUTOR.submit(_fill_confirmation_pool, action)
+    text = random.choice(pool) if pool else "Action done."
+    # add_* callers append the new ID themselves
+    if doc_id and not action.startswith("add_"):
+        return f"{text} (ID: {doc_id})"
+    return text
 
-def add_student(params):
+def _fill_confirmation_pool(action):
+    pr = CONFIRMATION_PROMPTS.get(action, "A cryptic success message.")
+    try:
+        resp = generate_content(pr)
+        if resp.candidates:
+            text = resp.candidates[0].content.parts[0].text.strip()[:100]
+            with _confirmation_lock:
+                pool = _confirmation_pool.setdefault(action, [])
+                if len(pool) < CONFIRMATION_POOL_SIZE:
+                    pool.append(text)
+    except Exception as e:
+        logging.error(f"❌ Failed to generate confirmation: {e}")
+    finally:
+        with _confirmation_lock:
+            _confirmation_filling.discard(action)
+
+def build_student_doc(params):
+    """
+    Validates params and returns (doc, None) for a new student, or
+    (None, error message).
+    """
     name = params.get("name")
     if not name:
-        return {"error": "Missing 'name'."}, 400
+        return None, "Missing 'name'."
     age = _safe_int(params.get("age"))
     sclass = params.get("class")
     division = params.get("division")
     if not sclass or not division:
-        return {"error": "Missing 'class' or 'division'."}, 400
+        return None, "Missing 'class' or 'division'."
     sid = gen_student_id(name, age, division)
     doc = {
         "id": sid,
@@ -237,10 +662,27 @@ def add_student(params):
         "guardian_name": params.get("guardian_name"),
         "guardian_phone": params.get("guardian_phone"),
         "attendance": params.get("attendance"),
-        "grades": params.get("grades") or {},
-        "grades_history": []
+        "grades": params.get("grades") or {}
     }
-    db.collection("students").document(sid).set(doc)
+    return doc, None
+
+# create() refuses an existing ID, so a collision costs a retry rather than
+# silently overwriting another student
+ADD_STUDENT_ATTEMPTS = 3
+
+def add_student(params):
+    for attempt in range(ADD_STUDENT_ATTEMPTS):
+        doc, err = build_student_doc(params)
+        if err:
+            return {"error": err}, 400
+        try:
+            students_ref().document(doc["id"]).create(doc)
+            break
+        except Conflict:
+            if attempt == ADD_STUDENT_ATTEMPTS - 1:
+                return {"error": "Could not allocate a unique student ID."}, 409
+    name, sid = doc["name"], doc["id"]
+    invalidate_students_cache()
     log_activity("ADD_STUDENT", f"Added {name} => {sid}")
     conf = comedic_confirmation("add_student", name, sid)
     return {"message": f"{conf} (ID: {sid})"}, 200
@@ -249,26 +691,27 @@ def update_student(params):
     sid = params.get("id")
     if not sid:
         return {"error": "Missing 'id'."}, 400
-    ref = db.collection("students").document(sid)
-    snap = ref.get()
-    if not snap.exists():
-        return {"error": f"No doc {sid} found."}, 404
-    upd = {}
-    for k, v in params.items():
-        if k == "id":
-            continue
-        if k == "grades":
-            old_g = snap.to_dict().get("grades", {})
-            h = snap.to_dict().get("grades_history", [])
-            h.append({"old": old_g, "new": v})
-            upd["grades_history"] = h
-        upd[k] = v
+    upd = {k: v for k, v in params.items() if k != "id"}
     # Validation: Ensure 'class' and 'division' are not empty if they are being updated
     if 'class' in upd and not upd['class']:
         return {"error": "The 'class' field cannot be empty."}, 400
     if 'division' in upd and not upd['division']:
         return {"error": "The 'division' field cannot be empty."}, 400
-    ref.update(upd)
+    ref = students_ref().document(sid)
+    # No read needed: update() only succeeds if the doc exists, and a batch is
+    # atomic, so a missing student leaves no orphan history entry behind
+    batch = get_db().batch()
+    batch.update(ref, upd)
+    if "grades" in upd:
+        batch.set(ref.collection("grade_history").document(), {
+            "new": upd["grades"],
+            "ts": firestore.SERVER_TIMESTAMP
+        })
+    try:
+        batch.commit()
+    except NotFound:
+        return {"error": f"No doc {sid} found."}, 404
+    invalidate_students_cache()
     log_activity("UPDATE_STUDENT", f"Updated {sid} => {upd}")
     c = comedic_confirmation("update_student", doc_id=sid)
     return {"message": c}, 200
@@ -277,9 +720,9 @@ def analytics_student(params):
     sid = params.get("id")
     if not sid:
         return {"error": "Missing 'id'."}, 400
-    ref = db.collection("students").document(sid)
+    ref = students_ref().document(sid)
     snap = ref.get()
-    if not snap.exists():
+    if not snap.exists:
         return {"error": f"No doc with id {sid}."}, 404
     # Minimal stub or implement analytics logic here
     return {"message": "(Analytics not fully implemented)."}, 200
@@ -287,22 +730,49 @@ def analytics_student(params):
 ###############################################################################
 # 10. Classification
 ###############################################################################
+# Kept byte-identical across calls (user prompt goes last) so the provider
+# can reuse its cached prefill for the instructions.
+CLASSIFY_PROMPT_PREFIX = (
+    "You are an advanced assistant that decides if the user prompt is casual or a Firestore operation.\n"
+    "If casual => {\"type\":\"casual\",\"reply\":\"<your response to the user>\"}\n"
+    "If firestore => {\"type\":\"firestore\",\"action\":\"...\",\"parameters\":{...}}\n"
+    "Allowed actions: add_student, update_student, delete_student, view_students, cleanup_data, analytics_student, view_grades, add_grade, update_grade, delete_grade.\n"
+    "Output JSON only.\n"
+)
+
+# Unambiguous phrasings classified locally, without a Gemini call. Student
+# IDs are gen_student_id()'s NAME[:4] + age + division letter + 4 digits.
+_STUDENT_ID = r"(?P<id>[A-Z]{1,4}\d{1,3}[A-Z]\d{4})"
+_FAST_PATTERNS = [
+    (re.compile(r"^\s*clean\s*up(?:\s+(?:the\s+)?data)?\s*$", re.I),
+     lambda m: {"type": "firestore", "action": "cleanup_data", "parameters": {}}),
+    (re.compile(r"^\s*(?i:delete\s+student)\s+" + _STUDENT_ID + r"\s*$"),
+     lambda m: {"type": "firestore", "action": "delete_student", "parameters": {"id": m.group("id")}}),
+    (re.compile(r"^\s*(?i:analytics(?:\s+for)?)\s+" + _STUDENT_ID + r"\s*$"),
+     lambda m: {"type": "firestore", "action": "analytics_student", "parameters": {"id": m.group("id")}}),
+]
+
+def fast_classify(prompt):
+    """
+    Returns the classification for a prompt matching _FAST_PATTERNS, else None.
+    """
+    for pat, build in _FAST_PATTERNS:
+        m = pat.match(prompt)
+        if m:
+            return build(m)
+    return None
+
 def classify_casual_or_firestore(prompt):
-    cp = (
-        "You are an advanced assistant that decides if the user prompt is casual or a Firestore operation.\n"
-        "If casual => {\"type\":\"casual\"}\n"
-        "If firestore => {\"type\":\"firestore\",\"action\":\"...\",\"parameters\":{...}}\n"
-        "Allowed actions: add_student, update_student, delete_student, view_students, cleanup_data, analytics_student, view_grades, add_grade, update_grade, delete_grade.\n"
-        f"User Prompt:'{prompt}'\n"
-        "Output JSON only."
-    )
-    r = model.generate_content(cp)
-    if not r.candidates:
+    d = fast_classify(prompt)
+    if d is not None:
+        return d
+    cp = CLASSIFY_PROMPT_PREFIX + f"User Prompt:'{normalize_prompt(prompt)}'"
+    raw = cached_generate(cp)
+    if raw is None:
         return {"type": "casual"}
-    raw = r.candidates[0].content.parts[0].text.strip()
     raw = remove_code_fences(raw)
     try:
-        d = json.loads(raw)
+        d = orjson.loads(raw)
         if "type" not in d:
             d["type"] = "casual"
         return d
@@ -312,8 +782,12 @@ def classify_casual_or_firestore(prompt):
 ###############################################################################
 # 11. Searching & Deletion
 ###############################################################################
+# Fields the delete-by-name flow lists for each match
+MATCH_FIELDS = ["name", "class", "division", "age"]
+
 def search_students_by_name(name):
-    docs = db.collection("students").where("name", "==", name).stream()
+    query = students_ref().where(filter=FieldFilter("name", "==", name)).select(MATCH_FIELDS)
+    docs = cached_student_docs(("name", name), query)
     results = []
     for d in docs:
         st = d.to_dict()
@@ -321,12 +795,15 @@ def search_students_by_name(name):
         results.append(st)
     return results
 
+FIRST_CHOICES = frozenset({"first", "1", "one"})
+SECOND_CHOICES = frozenset({"second", "2", "two"})
+
 def interpret_delete_choice(user_input, candidates):
     txt = user_input.strip().lower()
-    if txt in ["first", "1", "one"]:
+    if txt in FIRST_CHOICES:
         if len(candidates) > 0:
             return candidates[0]["id"]
-    elif txt in ["second", "2", "two"]:
+    elif txt in SECOND_CHOICES:
         if len(candidates) > 1:
             return candidates[1]["id"]
     for c in candidates:
@@ -342,76 +819,88 @@ def cleanup_data():
     Reads docs from Firestore, removes duplicates by name (keeps the most complete record),
     and removes documents with no name.
     """
-    all_docs = db.collection("students").stream()
-    doc_map = {}
-    records = []
-    for d in all_docs:
-        data = d.to_dict()
-        data["id"] = d.id  # real doc ID
-        doc_map[d.id] = d  # store reference if needed
-        records.append(data)
-
-    from collections import defaultdict
-    name_groups = defaultdict(list)
+    # Single pass: keep the best-scoring doc per name, queue the rest for deletion
+    best = {}  # normalized name -> (score, snapshot)
     removed_for_no_name = []
-    for st in records:
+    duplicates_removed = []
+    refs_to_delete = []
+    for d in students_ref().stream():
+        st = d.to_dict()
         nm = str(st.get("name") or "").strip().lower()
         if not nm:
-            # remove doc
-            ref = doc_map[st["id"]]
-            ref.reference.delete()
-            removed_for_no_name.append(st["id"])
+            refs_to_delete.append(d.reference)
+            removed_for_no_name.append(d.id)
             continue
-        name_groups[nm].append(st)
-
-    duplicates_removed = []
-    for nm, group in name_groups.items():
-        if len(group) > 1:
-            # find best doc
-            best_score = -1
-            best_student = None
-            for st in group:
-                score = sum(1 for v in st.values() if v not in [None, "", {}])
-                if score > best_score:
-                    best_score = score
-                    best_student = st
-            best_id = best_student["id"]
-            for st in group:
-                if st["id"] != best_id:
-                    doc_map[st["id"]].reference.delete()
-                    duplicates_removed.append(st["id"])
+        score = sum(1 for v in st.values() if v not in (None, "", {}))
+        prev = best.get(nm)
+        if prev is None:
+            best[nm] = (score, d)
+            continue
+        if score > prev[0]:
+            best[nm] = (score, d)
+            loser = prev[1]
+        else:
+            loser = d
+        refs_to_delete.append(loser.reference)
+        duplicates_removed.append(loser.id)
+
+    # The deletes are independent, so a BulkWriter can send them in parallel
+    # with its own throttling, retrying each failed write a few times
+    if refs_to_delete:
+        bw = get_db().bulk_writer()
+        bw.on_write_error(lambda failure, _: failure.attempts < BULK_WRITE_ATTEMPTS)
+        for ref in refs_to_delete:
+            bw.delete(ref)
+        bw.close()
+        invalidate_students_cache()
 
     if removed_for_no_name:
         log_activity("CLEANUP_DATA", f"Removed doc(s) missing name => {removed_for_no_name}")
     if duplicates_removed:
         log_activity("CLEANUP_DATA", f"Removed duplicates => {duplicates_removed}")
 
-    return build_students_table_html("Data cleaned! Updated student records below:")
+    # Render the survivors we already hold instead of streaming the collection again
+    survivors = sorted((d for _, d in best.values()), key=lambda d: d.id)
+    return build_students_table_html("Data cleaned! Updated student records below:", docs=survivors)
 
-def build_students_table_html(heading="Student Records", sclass=None, division=None):
-    # New: Allow filtering by class and division
-    # Fetch class and division if provided
-    from flask import request  # Import here to avoid circular imports
+# Only the columns the table shows; skips anything else a student doc may
+# carry. The doc ID always comes back.
+TABLE_FIELDS = [
+    "name", "age", "class", "division", "address", "phone",
+    "guardian_name", "guardian_phone", "attendance", "grades",
+]
 
-    query = db.collection("students")
-    if sclass and division:
-        query = query.where("class", "==", sclass).where("division", "==", division)
-    elif sclass:
-        query = query.where("class", "==", sclass)
-    elif division:
-        query = query.where("division", "==", division)
+def _cell(value):
+    return escape(str(value))
 
-    all_docs = query.stream()
-    docs_list = []
-    for d in all_docs:
-        st = d.to_dict()
-        st["id"] = d.id
-        docs_list.append(st)
-
-    if not docs_list:
-        return "<p>No students found for the specified filters.</p>"
+def build_students_table_html(heading="Student Records", sclass=None, division=None, docs=None):
+    """
+    Returns the table as an iterator of HTML chunks (header, one chunk per
+    row, footer) so it can be streamed while Firestore is still sending
+    documents, or None if no students match. Pass docs (snapshots already
+    in hand) to render them without querying Firestore.
+    """
+    if docs is not None:
+        all_docs = iter(docs)
+    else:
+        # Filter by class and division when provided
+        query = students_ref()
+        if sclass and division:
+            query = (query.where(filter=FieldFilter("class", "==", sclass))
+                          .where(filter=FieldFilter("division", "==", division)))
+        elif sclass:
+            query = query.where(filter=FieldFilter("class", "==", sclass))
+        elif division:
+            query = query.where(filter=FieldFilter("division", "==", division))
+
+        all_docs = cached_student_docs((sclass, division), query.select(TABLE_FIELDS))
+    first = next(all_docs, None)
+    if first is None:
+        return None
+    return _students_table_chunks(heading, itertools.chain([first], all_docs))
 
-    html = f"""
+def _students_table_chunks(heading, all_docs):
+    yield f"""
 <div id="studentsSection" class="slideFromRight">
   <h4>{heading}</h4>
   <table class="table table-bordered table-sm">
@@ -434,20 +923,22 @@ def build_students_table_html(heading="Student Records", sclass=None, division=N
     <tbody>
     """
 
-    for st in docs_list:
-        sid = st["id"]
-        nm = st.get("name", "")
-        ag = st.get("age", "")
-        cl = st.get("class", "")
-        dv = st.get("division", "")  # Added division
-        ad = st.get("address", "")
-        ph = st.get("phone", "")
-        gn = st.get("guardian_name", "")
-        gp = st.get("guardian_phone", "")
-        at = st.get("attendance", "")
+    for d in all_docs:
+        st = d.to_dict()
+        sid = _cell(d.id)
+        nm = _cell(st.get("name", ""))
+        ag = _cell(st.get("age", ""))
+        cl = _cell(st.get("class", ""))
+        dv = _cell(st.get("division", ""))  # Added division
+        ad = _cell(st.get("address", ""))
+        ph = _cell(st.get("phone", ""))
+        gn = _cell(st.get("guardian_name", ""))
+        gp = _cell(st.get("guardian_phone", ""))
+        at = _cell(st.get("attendance", ""))
         gr = st.get("grades", "")
         if isinstance(gr, dict):
-            gr = json.dumps(gr)
+            gr = orjson.dumps(gr).decode()
+        gr = _cell(gr)
 
         row = f"""
     <tr>
@@ -463,19 +954,18 @@ def build_students_table_html(heading="Student Records", sclass=None, division=N
       <td contenteditable="true">{at}</td>
       <td contenteditable="true">{gr}</td>
       <td>
-        <button class="btn btn-danger btn-delete-row" onclick="deleteRow('{sid}')">🗑️</button>
+        <button class="btn btn-danger btn-delete-row" data-id="{sid}" onclick="deleteRow(this.dataset.id)">🗑️</button>
       </td>
     </tr>
     """
-        html += row
+        yield row
 
-    html += """
+    yield """
     </tbody>
   </table>
   <button class="btn btn-success" onclick="saveTableEdits()">Save</button>
 </div>
 """
-    return html
 
 ###############################################################################
 # 13. Grades Functions
@@ -490,7 +980,7 @@ def add_grade(params):
         "subject": subject,
         "grades": grades  # e.g., {"student_id1": {"term1": 85, "term2": 90, "term3": 88}, ...}
     }
-    db.collection("grades").document(doc_id).set(doc)
+    get_db().collection("grades").document(doc_id).set(doc)
     log_activity("ADD_GRADE", f"Added subject {subject} with ID {doc_id}")
     conf = comedic_confirmation("add_grade", name=subject, doc_id=doc_id)
     return {"message": f"{conf} (ID: {doc_id})"}, 200
@@ -504,18 +994,14 @@ def update_grade(params):
     if not all([subject_id, student_id, term, marks is not None]):
         return {"error": "Missing required fields."}, 400
 
-    ref = db.collection("grades").document(subject_id)
-    snap = ref.get()
-    if not snap.exists():
+    ref = get_db().collection("grades").document(subject_id)
+    # Write just this student's term; update() fails for a missing subject,
+    # so no read is needed and other students' grades aren't rewritten
+    path = firestore.FieldPath("grades", str(student_id), str(term)).to_api_repr()
+    try:
+        ref.update({path: marks})
+    except NotFound:
         return {"error": f"No subject with ID {subject_id} found."}, 404
-
-    grades = snap.to_dict().get("grades", {})
-    student_grades = grades.get(student_id, {})
-    old_marks = student_grades.get(term, None)
-    student_grades[term] = marks
-    grades[student_id] = student_grades
-
-    ref.update({"grades": grades})
     log_activity("UPDATE_GRADE", f"Updated subject {subject_id}, student {student_id}, term {term} to {marks}")
     conf = comedic_confirmation("update_grade", doc_id=subject_id)
     return {"message": conf}, 200
@@ -527,9 +1013,9 @@ def delete_grade(params):
     if not all([subject_id, student_id]):
         return {"error": "Missing 'subject_id' or 'student_id'."}, 400
 
-    ref = db.collection("grades").document(subject_id)
+    ref = get_db().collection("grades").document(subject_id)
     snap = ref.get()
-    if not snap.exists():
+    if not snap.exists:
         return {"error": f"No subject with ID {subject_id} found."}, 404
 
     grades = snap.to_dict().get("grades", {})
@@ -548,11 +1034,11 @@ def view_grades(params):
     """
     subject = params.get("subject")
     if subject:
-        query = db.collection("grades").where("subject", "==", subject)
+        query = get_db().collection("grades").where(filter=FieldFilter("subject", "==", subject))
     else:
-        query = db.collection("grades")
+        query = get_db().collection("grades")
 
-    grades_docs = query.stream()
+    grades_docs = stream_pages(query)
     grades_list = []
     for d in grades_docs:
         grade = d.to_dict()
@@ -560,9 +1046,9 @@ def view_grades(params):
         grades_list.append(grade)
 
     if not grades_list:
-        return "<p>No grades found.</p>"
+        return None
 
-    html = f"""
+    parts = [f"""
 <div id="gradesSection" class="slideFromRight">
   <h4>Student Grades</h4>
   <table class="table table-bordered table-sm">
@@ -578,16 +1064,17 @@ def view_grades(params):
       </tr>
     </thead>
     <tbody>
-    """
+    """]
 
     for grade in grades_list:
-        subject_id = grade.get("subject_id", "")
-        subject_name = grade.get("subject", "")
+        subject_id = _cell(grade.get("subject_id", ""))
+        subject_name = _cell(grade.get("subject", ""))
         grades = grade.get("grades", {})
         for student_id, terms in grades.items():
-            term1 = terms.get("term1", "")
-            term2 = terms.get("term2", "")
-            term3 = terms.get("term3", "")
+            student_id = _cell(student_id)
+            term1 = _cell(terms.get("term1", ""))
+            term2 = _cell(terms.get("term2", ""))
+            term3 = _cell(terms.get("term3", ""))
             row = f"""
     <tr>
       <td>{subject_id}</td>
@@ -597,41 +1084,46 @@ def view_grades(params):
       <td contenteditable="true">{term2}</td>
       <td contenteditable="true">{term3}</td>
       <td>
-        <button class="btn btn-danger btn-delete-grade" onclick="deleteGrade('{subject_id}', '{student_id}')">🗑️</button>
+        <button class="btn btn-danger btn-delete-grade" data-subject="{subject_id}" data-student="{student_id}"
+                onclick="deleteGrade(this.dataset.subject, this.dataset.student)">🗑️</button>
       </td>
     </tr>
             """
-            html += row
+            parts.append(row)
 
-    html += """
+    parts.append("""
     </tbody>
   </table>
   <button class="btn btn-success" onclick="saveGradesEdits()">Save Grades</button>
 </div>
-"""
-    return html
+""")
+    return "".join(parts)
 
 ###############################################################################
 # 14. State Handling
 ###############################################################################
 def handle_state_machine(user_prompt):
-    st = conversation_context["state"]
-    pend = conversation_context["pending_params"]
-    delete_candidates = conversation_context.get("delete_candidates", [])
+    """
+    Returns (chat_text, panel_html). panel_html is None unless the reply
+    is a table for the side panel.
+    """
+    st = conversation_context.state
+    pend = conversation_context.pending_params
+    delete_candidates = conversation_context.delete_candidates
 
     # Handle states requiring additional information
     if st == STATE_AWAITING_DELETE_CHOICE:
         chosen = interpret_delete_choice(user_prompt, delete_candidates)
-        conversation_context["state"] = STATE_IDLE
-        conversation_context["delete_candidates"] = []
+        conversation_context.state = STATE_IDLE
+        conversation_context.delete_candidates = []
         if not chosen:
-            return "I can't interpret your choice. (Try 'first', 'second', or an actual ID)."
+            return "I can't interpret your choice. (Try 'first', 'second', or an actual ID).", None
         ok, msg = delete_student_doc(chosen)
         if not ok:
-            return msg
+            return msg, None
         log_activity("DELETE_STUDENT", f"Deleted {chosen} after choice.")
         conf = comedic_confirmation("delete_student", doc_id=chosen)
-        return conf
+        return conf, None
 
     elif st == STATE_AWAITING_VIEW_FILTER:
         # Expecting class and division
@@ -642,25 +1134,28 @@ def handle_state_machine(user_prompt):
                 missing.append("'class'")
             if not filters.get("division"):
                 missing.append("'division'")
-            return f"I still need the student's {' and '.join(missing)}. Please provide them or type 'cancel'."
+            return f"I still need the student's {' and '.join(missing)}. Please provide them or type 'cancel'.", None
 
         sclass = filters.get("class")
         division = filters.get("division")
-        conversation_context["state"] = STATE_IDLE
-        conversation_context["pending_params"] = {}
-        conversation_context["last_intended_action"] = None
+        conversation_context.state = STATE_IDLE
+        conversation_context.pending_params = {}
+        conversation_context.last_intended_action = None
 
-        return build_students_table_html(f"Displaying students for Class {sclass} Division {division}:", sclass, division)
+        heading = f"Displaying students for Class {sclass} Division {division}:"
+        panel = build_students_table_html(heading, sclass, division)
+        return (heading if panel else "No students found for the specified filters."), panel
 
     else:
         # IDLE state: classify and handle actions
         c = classify_casual_or_firestore(user_prompt)
         if c.get("type") == "casual":
-            r = model.generate_content(user_prompt)
-            if r.candidates:
-                return r.candidates[0].content.parts[0].text.strip()
-            else:
-                return "I'm out of words..."
+            # The classifier answers casual prompts itself; only fall back to a
+            # second call when it didn't
+            if c.get("reply"):
+                return c["reply"], None
+            reply = cached_generate(normalize_prompt(user_prompt))
+            return (reply if reply is not None else "I'm out of words..."), None
 
         elif c.get("type") == "firestore":
             a = c.get("action", "")
@@ -670,25 +1165,30 @@ def handle_state_machine(user_prompt):
                 sclass = p.get("class")
                 division = p.get("division")
                 if sclass and division:
-                    return build_students_table_html(f"Displaying students for Class {sclass} Division {division}:", sclass, division)
+                    heading = f"Displaying students for Class {sclass} Division {division}:"
+                    panel = build_students_table_html(heading, sclass, division)
+                    return (heading if panel else "No students found for the specified filters."), panel
                 elif sclass or division:
                     # If only one filter is provided, prompt for the other
-                    conversation_context["state"] = STATE_AWAITING_VIEW_FILTER
-                    conversation_context["pending_params"] = p
-                    conversation_context["last_intended_action"] = "view_students"
+                    conversation_context.state = STATE_AWAITING_VIEW_FILTER
+                    conversation_context.pending_params = p
+                    conversation_context.last_intended_action = "view_students"
                     missing = []
                     if not sclass:
                         missing.append("'class'")
                     if not division:
                         missing.append("'division'")
-                    return f"I need the student's {' and '.join(missing)} to filter. Please provide them or type 'cancel'."
+                    return f"I need the student's {' and '.join(missing)} to filter. Please provide them or type 'cancel'.", None
+                else:
+                    panel = build_students_table_html("Student Records")
+                    return ("Student Records" if panel else "No students found."), panel
 
             elif a == "add_student":
                 # Ensure both 'name', 'class', and 'division' are provided
                 if not p.get("name") or not p.get("class") or not p.get("division"):
-                    conversation_context["state"] = STATE_AWAITING_STUDENT_INFO
-                    conversation_context["pending_params"] = p
-                    conversation_context["last_intended_action"] = "add_student"
+                    conversation_context.state = STATE_AWAITING_STUDENT_INFO
+                    conversation_context.pending_params = p
+                    conversation_context.last_intended_action = "add_student"
                     missing = []
                     if not p.get("name"):
                         missing.append("'name'")
@@ -696,23 +1196,23 @@ def handle_state_machine(user_prompt):
                         missing.append("'class'")
                     if not p.get("division"):
                         missing.append("'division'")
-                    return f"I need the student's {' ,'.join(missing)}. Please provide them or type 'cancel'."
+                    return f"I need the student's {' ,'.join(missing)}. Please provide them or type 'cancel'.", None
                 out, sts_code = add_student(p)
                 if sts_code == 200 and "message" in out:
                     # Comedic
                     funny = f"Write a short witty statement acknowledging we have a new student '{p['name']}'. " \
                             f"Ask if they'd like to add details like marks or attendance. Under 40 words, humorous."
-                    r2 = model.generate_content(funny)
+                    r2 = generate_content(funny)
                     if r2.candidates:
                         t = r2.candidates[0].content.parts[0].text.strip()
-                        return out["message"] + "\n\n" + t
+                        return out["message"] + "\n\n" + t, None
                     else:
-                        return out["message"]
+                        return out["message"], None
                 else:
-                    return out.get("error", "Error adding student.")
+                    return out.get("error", "Error adding student."), None
 
             elif a == "update_student":
-                return handle_update_student(p)
+                return handle_update_student(p), None
 
             elif a == "delete_student":
                 # Check if ID is provided
@@ -720,64 +1220,91 @@ def handle_state_machine(user_prompt):
                 if sid:
                     ok, msg = delete_student_doc(sid)
                     if not ok:
-                        return "No doc with that ID found."
+                        return "No doc with that ID found.", None
                     log_activity("DELETE_STUDENT", f"Deleted {sid} directly.")
                     conf = comedic_confirmation("delete_student", doc_id=sid)
-                    return conf
+                    return conf, None
                 # Else, check if name is provided
                 nm = p.get("name")
                 if not nm:
-                    return "We need an ID or name to delete."
+                    return "We need an ID or name to delete.", None
                 matches = search_students_by_name(nm)
                 if not matches:
-                    return f"No student named {nm} found."
+                    return f"No student named {nm} found.", None
                 if len(matches) == 1:
                     found_id = matches[0]["id"]
                     ok, msg = delete_student_doc(found_id)
                     if not ok:
-                        return "No doc with that ID found."
+                        return "No doc with that ID found.", None
                     log_activity("DELETE_STUDENT", f"Deleted {found_id}")
                     conf = comedic_confirmation("delete_student", doc_id=found_id)
-                    return conf
+                    return conf, None
                 else:
-                    conversation_context["state"] = STATE_AWAITING_DELETE_CHOICE
-                    conversation_context["delete_candidates"] = matches
+                    conversation_context.state = STATE_AWAITING_DELETE_CHOICE
+                    conversation_context.delete_candidates = matches
                     lines = []
                     for i, m in enumerate(matches):
                         lines.append(f"{i+1}. ID={m['id']} (class={m.get('class','')}{m.get('division','')}, age={m.get('age','')})")
                     listing = "\n".join(lines)
-                    return f"Multiple matches for {nm}:\n{listing}\nWhich one to delete? ('first','second', or the ID)."
+                    return f"Multiple matches for {nm}:\n{listing}\nWhich one to delete? ('first','second', or the ID).", None
 
             elif a == "cleanup_data":
-                return cleanup_data()
+                panel = cleanup_data()
+                return ("Data cleaned! Updated student records below:" if panel
+                        else "Data cleaned! No students found."), panel
 
             elif a == "view_grades":
                 # Optionally, accept subject filter
                 subject = p.get("subject")
-                return view_grades({"subject": subject})
+                panel = view_grades({"subject": subject})
+                return ("Student Grades" if panel else "No grades found."), panel
 
             elif a == "add_grade":
-                return add_grade(p)
+                out, sts_code = add_grade(p)
+                return out.get("message", out.get("error", "Error.")), None
 
             elif a == "update_grade":
-                return update_grade(p)
+                out, sts_code = update_grade(p)
+                return out.get("message", out.get("error", "Error.")), None
 
             elif a == "delete_grade":
-                return delete_grade(p)
+                out, sts_code = delete_grade(p)
+                return out.get("message", out.get("error", "Error.")), None
 
             else:
-                return f"Unknown Firestore action: {a}"
+                return f"Unknown Firestore action: {a}", None
 
         else:
-            return "I'm not sure what you're asking."
+            return "I'm not sure what you're asking.", None
 
 def handle_update_student(p):
-    return update_student(p)
+    out, sts_code = update_student(p)
+    return out.get("message", out.get("error", "Error."))
+
+# Fast intents: fixed commands answered without a Gemini round-trip
+HELP_TEXT = (
+    "Try: 'view students', 'add student <name> class <n> division <x>', "
+    "'update student <id> ...', 'delete student <name or ID>', 'cleanup data', "
+    "'view grades', 'add grade', 'update grade' or 'delete grade'."
+)
+
+def handle_view_students():
+    panel = build_students_table_html("Student Records")
+    return ("Student Records" if panel else "No students found."), panel
+
+def handle_help():
+    return HELP_TEXT, None
+
+FAST_INTENTS = [
+    (re.compile(r"^\s*(?:view|show|list)\s+(?:all\s+)?students?\s*$", re.I), handle_view_students),
+    (re.compile(r"^\s*help\s*$", re.I), handle_help),
+]
 
 ###############################################################################
 # 15. Additional Routes
 ###############################################################################
 @app.route("/delete_by_id", methods=["POST"])
+@limiter.limit(WRITE_RATE_LIMIT)
 def delete_by_id():
     data = request.json
     sid = data.get("id")
@@ -790,20 +1317,125 @@ def delete_by_id():
     conf = comedic_confirmation("delete_student", doc_id=sid)
     return jsonify({"success": True, "message": conf}), 200
 
+@app.route("/bulk_delete_by_ids", methods=["POST"])
+@limiter.limit(WRITE_RATE_LIMIT)
+def bulk_delete_by_ids():
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a JSON object."}), 400
+    ids = data.get("ids", [])
+    if not isinstance(ids, list):
+        return jsonify({"error": "'ids' must be a list."}), 400
+    ids = [sid for sid in ids if isinstance(sid, str) and sid]
+    if not ids:
+        return jsonify({"error": "No IDs"}), 400
+    refs = [students_ref().document(sid) for sid in ids]
+    found = [snap.reference for snap in get_db().get_all(refs) if snap.exists]
+    if not found:
+        return jsonify({"error": "No doc with those IDs."}), 404
+    for i in range(0, len(found), FIRESTORE_BATCH_LIMIT):
+        batch = get_db().batch()
+        for ref in found[i:i + FIRESTORE_BATCH_LIMIT]:
+            batch.delete(ref)
+        batch.commit()
+    invalidate_students_cache()
+    deleted = [ref.id for ref in found]
+    log_activity("DELETE_STUDENT", f"Deleted {deleted} via trash icon.")
+    conf = comedic_confirmation("delete_student", doc_id=", ".join(deleted))
+    return jsonify({"success": True, "deleted_ids": deleted, "message": conf}), 200
+
+@app.route("/add_students_bulk", methods=["POST"])
+@limiter.limit(WRITE_RATE_LIMIT)
+def add_students_bulk():
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a JSON object."}), 400
+    students = data.get("students", [])
+    if not isinstance(students, list):
+        return jsonify({"error": "'students' must be a list."}), 400
+    if not students:
+        return jsonify({"error": "No students provided."}), 400
+    docs = {}  # id -> input index
+    errors = []
+    added = []
+    failed = []
+
+    def on_error(failure, _):
+        if failure.code != code_pb2.ALREADY_EXISTS and failure.attempts < BULK_WRITE_ATTEMPTS:
+            return True
+        failed.append((failure.operation.reference.id, failure.message))
+        return False
+
+    # One BulkWriter sends the creates in parallel, with its own throttling.
+    # The callbacks go on before any write is queued, so only writes that
+    # actually landed are reported back.
+    bw = get_db().bulk_writer()
+    bw.on_write_result(lambda ref, result, _: added.append(ref.id))
+    bw.on_write_error(on_error)
+    for i, params in enumerate(students):
+        if not isinstance(params, dict):
+            errors.append({"index": i, "error": "Expected an object."})
+            continue
+        doc, err = build_student_doc(params)
+        if err:
+            errors.append({"index": i, "error": err})
+        else:
+            docs[doc["id"]] = i
+            # create() refuses an existing ID instead of overwriting it
+            bw.create(students_ref().document(doc["id"]), doc)
+    bw.close()
+    if not docs:
+        return jsonify({"error": "No valid students.", "errors": errors}), 400
+    errors.extend({"index": docs[sid], "error": msg} for sid, msg in failed)
+    if not added:
+        return jsonify({"error": "No students were added.", "errors": errors}), 409
+    invalidate_students_cache()
+    log_activity("ADD_STUDENT", f"Bulk added => {added}")
+    conf = comedic_confirmation("add_student")
+    return jsonify({"success": True, "added_ids": added, "errors": errors, "message": conf}), 200
+
+def _parse_grades(value):
+    """
+    The table sends grades as the raw cell text; store a JSON object as a
+    dict and anything that doesn't parse as the text itself.
+    """
+    if not isinstance(value, str) or not value:
+        return value
+    try:
+        return orjson.loads(value)
+    except orjson.JSONDecodeError:
+        return value
+
 @app.route("/bulk_update_students", methods=["POST"])
+@limiter.limit(WRITE_RATE_LIMIT)
 def bulk_update_students_route():
-    data = request.json
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a JSON object."}), 400
     ups = data.get("updates", [])
+    if not isinstance(ups, list):
+        return jsonify({"error": "'updates' must be a list."}), 400
     if not ups:
         return jsonify({"error": "No updates provided."}), 400
+    entries = [st for st in ups if isinstance(st, dict) and isinstance(st.get("id"), str) and st["id"]]
+    refs = [students_ref().document(st["id"]) for st in entries]
+    # One streaming get_all covers every existence check and the current values
+    current = {snap.id: snap.to_dict() for snap in get_db().get_all(refs) if snap.exists}
     updated = []
-    for st in ups:
-        sid = st.get("id")
-        if not sid:
-            continue
-        doc_ref = db.collection("students").document(sid)
-        snap = doc_ref.get()
-        if not snap.exists():
+    unchanged = 0
+    writes = []
+    for st, doc_ref in zip(entries, refs):
+        sid = st["id"]
+        if sid not in current:
             continue
         # Update fields
         fields_to_update = {}
@@ -812,18 +1444,38 @@ def bulk_update_students_route():
                 continue
             if k == "age":
                 fields_to_update["age"] = _safe_int(v)
+            elif k == "grades":
+                fields_to_update["grades"] = _parse_grades(v)
             else:
                 fields_to_update[k] = v
-        doc_ref.update(fields_to_update)
+        # Skip the write when nothing actually differs from what's stored
+        existing = current[sid]
+        changed = {k: v for k, v in fields_to_update.items() if existing.get(k) != v}
+        if not changed:
+            unchanged += 1
+            continue
+        writes.append((doc_ref, changed))
         updated.append(sid)
+    committed = set(_commit_chunks(writes))
+    if writes:
+        # Even a partly failed run may have changed some docs
+        invalidate_students_cache()
+    failed = [sid for sid in updated if sid not in committed]
+    updated = [sid for sid in updated if sid in committed]
+    if unchanged:
+        logging.info("Bulk update skipped %d unchanged doc(s)", unchanged)
     if updated:
         log_activity("BULK_UPDATE", f"Updated => {updated}")
-    return jsonify({"success": True, "updated_ids": updated}), 200
+    out = {"success": not failed, "updated_ids": updated, "failed_ids": failed}
+    if failed:
+        out["error"] = f"Could not save {', '.join(failed)}."
+    return jsonify(out), 200
 
 ###############################################################################
 # 16. Grades Routes
 ###############################################################################
 @app.route("/add_grade", methods=["POST"])
+@limiter.limit(WRITE_RATE_LIMIT)
 def add_grade_route():
     data = request.json
     out, sts_code = add_grade(data)
@@ -833,6 +1485,7 @@ def add_grade_route():
         return jsonify({"error": out.get("error", "Failed to add grade.")}), sts_code
 
 @app.route("/update_grade", methods=["POST"])
+@limiter.limit(WRITE_RATE_LIMIT)
 def update_grade_route():
     data = request.json
     out, sts_code = update_grade(data)
@@ -842,6 +1495,7 @@ def update_grade_route():
         return jsonify({"error": out.get("error", "Failed to update grade.")}), sts_code
 
 @app.route("/delete_grade", methods=["POST"])
+@limiter.limit(WRITE_RATE_LIMIT)
 def delete_grade_route():
     data = request.json
     out, sts_code = delete_grade(data)
@@ -853,45 +1507,127 @@ def delete_grade_route():
 @app.route("/view_grades", methods=["GET"])
 def view_grades_route():
     subject = request.args.get("subject")
-    return view_grades({"subject": subject})
+    return view_grades({"subject": subject}) or "<p>No grades found.</p>"
 
 ###############################################################################
 # 17. The main HTML route with chat interface
 ###############################################################################
+# Startup work (memory load, welcome summary) runs on a daemon thread that
+# each serving process starts on its first request. Importing the module
+# does no Firestore or Gemini work, and under gunicorn --preload every
+# forked worker runs its own startup instead of waiting on the master's.
+# Routes that need its results wait on startup_ready.
+STARTUP_WAIT_SECONDS = 5
+SUMMARY_PREFIX = "PAST_ACTIVITIES_SUMMARY: "
+startup_ready = threading.Event()
+
+def _bootstrap():
+    global welcome_summary
+    try:
+        # The summary doesn't depend on memory, so let it run alongside the load
+        summary_future = _EXECUTOR.submit(generate_comedic_summary_of_past_activities)
+        mem, ctx = load_memory_from_firestore()
+        if mem:
+            # A fresh summary is appended below; drop the ones from past boots
+            conversation_memory.extend(
+                m for m in mem if not str(m.get("content", "")).startswith(SUMMARY_PREFIX)
+            )
+        if ctx:
+            conversation_context.update(ctx)
+
+        summary = summary_future.result()
+        welcome_summary = summary
+        # Append the summary as the first AI message in the chat
+        conversation_memory.append({"role": "system", "content": SUMMARY_PREFIX + summary})
+        save_memory_to_firestore()
+        logging.info("Startup summary: %s", summary)
+    except Exception as e:
+        logging.error(f"❌ Startup failed: {e}")
+    finally:
+        startup_ready.set()
+
+_bootstrap_started = False
+_bootstrap_lock = threading.Lock()
+
+@app.before_request
+def _start_bootstrap():
+    global _bootstrap_started
+    if _bootstrap_started:
+        return
+    # Concurrent first requests must not both load memory and append a summary
+    with _bootstrap_lock:
+        if _bootstrap_started:
+            return
+        _bootstrap_started = True
+    threading.Thread(target=_bootstrap, name="startup", daemon=True).start()
+
 @app.route("/")
 def index():
-    global welcome_summary
+    startup_ready.wait(timeout=STARTUP_WAIT_SECONDS)
     # We'll embed the comedic summary as the first AI message in the chat
-    return render_template("index.html", summary=welcome_summary)
+    resp = make_response(render_template("index.html", summary=welcome_summary))
+    # The page only changes with the summary, so reloads can get a 304
+    resp.add_etag()
+    return resp.make_conditional(request)
 
 ###############################################################################
 # 18. Process Prompt Route
 ###############################################################################
+def _ndjson_reply(message, panel_chunks):
+    """
+    One JSON object per line: {"message": ...} first, then a
+    {"panel_chunk": ...} line per chunk of table HTML.
+    """
+    yield orjson.dumps({"message": message}) + b"\n"
+    for chunk in panel_chunks:
+        yield orjson.dumps({"panel_chunk": chunk}) + b"\n"
+
 @app.route("/process_prompt", methods=["POST"])
+@limiter.limit(PROMPT_RATE_LIMIT)
 def process_prompt():
-    data = request.json
-    prompt = data.get("prompt")
-    if not prompt:
-        return jsonify({"error": "No prompt provided."}), 400
-
-    # Handle state machine
-    response_message = handle_state_machine(prompt)
+    startup_ready.wait(timeout=STARTUP_WAIT_SECONDS)
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        data = {}
+    prompt = data.get("prompt") if isinstance(data, dict) else None
+    if not prompt or not isinstance(prompt, str):
+        return Response(orjson.dumps({"error": "No prompt provided."}), status=400,
+                        mimetype="application/json")
+
+    # Fixed commands skip Gemini entirely, unless the state machine is
+    # waiting on a follow-up answer
+    fast = None
+    if conversation_context.state not in FOLLOW_UP_STATES:
+        fast = next((h for pat, h in FAST_INTENTS if pat.match(prompt)), None)
+    if fast:
+        response_message, panel = fast()
+    else:
+        # Handle state machine
+        response_message, panel = handle_state_machine(prompt)
 
     # Append to conversation memory
     conversation_memory.append({"role": "user", "content": prompt})
     conversation_memory.append({"role": "assistant", "content": response_message})
 
-    # Trim memory if exceeds
-    if len(conversation_memory) > MAX_MEMORY:
-        conversation_memory.pop(0)
-
     save_memory_to_firestore()
 
-    return jsonify({"message": response_message}), 200
+    if panel is not None and not isinstance(panel, str):
+        # Table replies arrive as chunks; stream them to clients that ask
+        if request.accept_mimetypes.best == "application/x-ndjson":
+            return Response(stream_with_context(_ndjson_reply(response_message, panel)),
+                            mimetype="application/x-ndjson")
+        panel = "".join(panel)
+
+    return Response(orjson.dumps({"message": response_message, "panel": panel}), status=200,
+                    mimetype="application/json")
 
 ###############################################################################
 # 19. Helper Function to Extract Filters
 ###############################################################################
+_CLASS_FILTER_RE = re.compile(r'class\s*(\d+)')
+_DIVISION_FILTER_RE = re.compile(r'division\s*([a-z])')
+
 def extract_filters(user_prompt):
     """
     A simple parser to extract 'class' and 'division' from user prompt.
@@ -900,8 +1636,9 @@ def extract_filters(user_prompt):
     filters = {}
     # Example parsing logic (needs to be improved for real-world use)
     # Look for patterns like 'class 10A' or 'class 10' and 'division A'
-    class_match = re.search(r'class\s*(\d+)', user_prompt.lower())
-    division_match = re.search(r'division\s*([a-zA-Z])', user_prompt.lower())
+    text = user_prompt.lower()
+    class_match = _CLASS_FILTER_RE.search(text)
+    division_match = _DIVISION_FILTER_RE.search(text)
     if class_match:
         filters['class'] = class_match.group(1)
     if division_match:
@@ -912,16 +1649,8 @@ def extract_filters(user_prompt):
 # 20. Actually run Flask
 ###############################################################################
 if __name__ == "__main__":
-    mem, ctx = load_memory_from_firestore()
-    if mem:
-        conversation_memory.extend(mem)
-    if ctx:
-        conversation_context.update(ctx)
-
-    summary = generate_comedic_summary_of_past_activities()
-    welcome_summary = summary
-    conversation_memory.append({"role": "system", "content": "PAST_ACTIVITIES_SUMMARY: " + summary})
-    save_memory_to_firestore()
-    logging.info("Startup summary: " + summary)
-
-    app.run(debug=True, port=8000)
+    # Local runs only. In production serve with a threaded gunicorn worker:
+    #   gunicorn -w 4 -k gthread --threads 8 gemini_integration:app
+    # or with gevent workers:
+    #   USE_GEVENT=1 gunicorn -w 4 -k gevent --worker-connections 1000 gemini_integration:app
+    app.run(debug=DEBUG, port=8000, threaded=True)